@@ -7,14 +7,48 @@ import subprocess
 import os
 import sys
 import logging
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+from itertools import zip_longest
 from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 from prometheus_client import make_wsgi_app
-from wsgiref.simple_server import make_server, WSGIRequestHandler
+from prometheus_client.samples import Sample
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIRequestHandler, WSGIServer
 
 VERSION = "0.0.6"
 
+# Every line printed by ibqueryerrors on STDERR is matched once against this
+# alternation, the name of the matched group tells which error it is.
+_STDERR_PATTERNS = (
+    ('bad_status_error', r'src\/query\_smp\.c\:[\d]+\; (?:mad|umad) \((DR path .*) Attr .*\) bad status ([\d]+); (.*)'),  # noqa: E501
+    ('query_failed_error', r'ibwarn: \[\d+\] query_and_dump: (\w+) query failed on (.*), Lid (\d+) port (\d+)'),
+    ('mad_rpc_recv_failed', r'ibwarn: \[\d+\] _do_madrpc: recv failed: [\w\s]+'),
+    ('mad_rpc_failed_error', r'ibwarn: \[\d+\] mad_rpc: _do_madrpc failed; dport \(([\w;\s]+)\)'),
+    ('query_cap_mask_error', r'ibwarn: \[\d+\] query_cap_mask: (\w+) query failed on (.*), ([\w;\s]+) port (\d+)'),
+    ('print_error', r'ibwarn: \[\d+\] print_errors: (\w+) query failed on (.*), ([\w;\s]+) port (\d+)'),
+)
+_COMBINED_STDERR_PROG = re.compile(
+    '|'.join('(?P<{}>{})'.format(name, pattern) for name, pattern in _STDERR_PATTERNS))
+
+# Counters are printed as "[PortXmitData == 1234 (4.6Ki)]" after each port
+_COUNTER_PROG = re.compile(r'\[(\w+) == (\d+)[^\]]*\]')
+
+# Fallback for the node name map lines that do not split as 0x<GUID> "<name>"
+_NODE_NAME_PROG = re.compile(r'(?P<GUID>0x\S+)\s+"(?P<name>.*)"')
+
+# ibqueryerrors stdout is made of one header line per switch or CA followed
+# by pairs of port and link info lines
+_HEADER_PROG = re.compile(r'^Errors for (?:0[x][\da-f]+ )?\"(.*)\"$')
+_SWITCH_ALL_PORTS_PROG = re.compile(r'\s*GUID 0[x][\da-f]+ port ALL: (?:\[.*\])+')
+# _PORT_PROG and _ACTIVE_LINK_PROG are kept as fallbacks, they are only tried
+# on the lines that the string splitting in parse_port() and
+# parse_active_link() does not recognise
+_PORT_PROG = re.compile(r'\s*GUID (0x\S+) port (\d+):(.*)')
+_ACTIVE_LINK_PROG = re.compile(r'\s*Link info:\s+(?P<LID>\d+)\s+(?P<port>\d+).*(?<!\d)(?P<Width>\d+)X\s+(?P<Speed>[\d+\.]*) Gbps.* Active\/  LinkUp.*(?P<remote_GUID>0x\w+)\s+(?P<remote_LID>\d+)\s+(?P<remote_port>\d+).*\"(?P<node_name>.*)\"')  # noqa: E501
+
 class ParsingError(Exception):
     pass
 
@@ -22,22 +56,68 @@ class InfinibandItem(str, Enum):
     CA = 'ca'
     SWITCH = 'switch'
 
+# Number of perfquery processes resetting counters at the same time, and
+# number of seconds after which a hanging perfquery is killed
+_RESET_WORKERS = 8
+_RESET_TIMEOUT = 30
+
+# Plain strings used as component on the parsing path, they avoid going
+# through the Enum machinery for every port
+_CA = sys.intern(InfinibandItem.CA.value)
+_SWITCH = sys.intern(InfinibandItem.SWITCH.value)
+_COMPONENTS = {InfinibandItem.CA: _CA, InfinibandItem.SWITCH: _SWITCH}
+
 class InfinibandCollector(object):
-    def __init__(self, can_reset_counter, input_file, node_name_map):
+    def __init__(self, can_reset_counter, input_file, node_name_map,
+                 cache_ttl=0):
         self.can_reset_counter = can_reset_counter
         self.input_file = input_file
         self.node_name_map = node_name_map
+        self.cache_ttl = cache_ttl
+
+        # An absolute path lets subprocess spawn the infiniband-diags tools with
+        # posix_spawn() instead of fork() + exec() when available
+        self.ibqueryerrors_path = None
+        if not self.input_file:
+            self.ibqueryerrors_path = which('ibqueryerrors') or 'ibqueryerrors'
+        self.perfquery_path = None
+        self.reset_executor = None
+        if self.can_reset_counter:
+            self.perfquery_path = which('perfquery') or 'perfquery'
+            self.reset_executor = ThreadPoolExecutor(
+                max_workers=_RESET_WORKERS)
+        # Ports with a perfquery reset submitted and not finished yet
+        self.resets_in_flight = set()
+        self.resets_lock = threading.Lock()
 
         self.node_name = {}
         if self.node_name_map:
+            # Lines of the node name map look like: 0x<GUID> "<name>"
             with open(self.node_name_map) as f:
                 for line in f:
-                    m = re.search(r'(?P<GUID>0x.*)\s+"(?P<name>.*)"', line)
+                    line = line.strip()
+                    if not line or line.startswith('#'):
+                        continue
+                    fields = line.split(None, 1)
+                    if len(fields) == 2 and fields[0].startswith('0x'):
+                        name, quote, _ = fields[1].rpartition('"')
+                        if quote and name.startswith('"'):
+                            self.node_name[fields[0]] = name[1:]
+                            continue
+                    # Lines with another layout, e.g. something before the
+                    # GUID, are left to the regex
+                    m = _NODE_NAME_PROG.search(line)
                     if m:
-                        self.node_name[m.group(1)] = m.group(2)
+                        self.node_name[m.group('GUID')] = m.group('name')
 
         self.scrape_with_errors = False
         self.metrics = {}
+        self.label_cache = {}
+        self.previous_label_cache = {}
+        self.pending_resets = []
+        self.lock = threading.Lock()
+        self.cache = None
+        self.cache_time = 0
 
         # Description based on https://community.mellanox.com/s/article/understanding-mlx5-linux-counters-and-status-parameters # noqa: E501
         # and IB specification Release 1.3
@@ -220,6 +300,17 @@ class InfinibandCollector(object):
                 'bits': 16,
             }
         }
+        # Counters are reset once they reach half of their maximum value
+        self.overflow_threshold = {
+            name: 1 << (info['bits'] - 1)
+            for name, info in self.counter_info.items()}
+
+        self.counter_names = tuple(self.counter_info)
+
+        # Dense index of the counters, see parse_counter() and init_metrics()
+        self.counter_idx = {name: i for i, name in enumerate(self.counter_names)}
+        self.counter_objs = []
+
         self.gauge_info = {
             'Speed': {
                 'help': 'Link current speed per lane.',
@@ -228,271 +319,378 @@ class InfinibandCollector(object):
                 'help': 'Lanes per link.',
             }
         }
+        self.gauge_names = tuple(self.gauge_info)
+
+        # Names of the metric families, built once instead of every scrape
+        self.metric_names = {
+            name: 'infiniband_' + name.lower()
+            for name in self.counter_names + self.gauge_names}
+
+        self.metric_labels = [
+            'component',
+            'local_name',
+            'local_guid',
+            'local_port',
+            'remote_guid',
+            'remote_port',
+            'remote_name'
+        ]
 
         self.bad_status_error_metric_name = 'infiniband_bad_status_error'
         self.bad_status_error_metric_help = 'Bad status error catched from STDERR by ibqueryerrors.'
         self.bad_status_error_metric_labels = ['path', 'status', 'error']
-        self.bad_status_error_pattern = r'src\/query\_smp\.c\:[\d]+\; (?:mad|umad) \((DR path .*) Attr .*\) bad status ([\d]+); (.*)'  # noqa: E501
-        self.bad_status_error_prog = re.compile(self.bad_status_error_pattern)
 
         self.query_failed_error_metric_name = 'infiniband_query_failed_error'
         self.query_failed_error_metric_help = 'Failed query catched from STDERR by ibqueryerrors.'
         self.query_failed_error_metric_labels = ['counter_name', 'local_name', 'lid', 'port']
-        self.query_failed_error_pattern = r'ibwarn: \[\d+\] query_and_dump: (\w+) query failed on (.*), Lid (\d+) port (\d+)'
-        self.query_failed_error_prog = re.compile(self.query_failed_error_pattern)
-
-        self.mad_rpc_recv_failed_pattern = r'ibwarn: \[\d+\] _do_madrpc: recv failed: [\w\s]+'
-        self.mad_rpc_recv_failed_prog = re.compile(self.mad_rpc_recv_failed_pattern)
 
         self.mad_rpc_failed_error_metric_name = 'infiniband_mad_rpc_failed_error'
         self.mad_rpc_failed_error_metric_help = 'ibwarn_mad_rpc error catched from STDERR by ibqueryerrors.'
         self.mad_rpc_failed_error_metric_labels = ['portid']
-        self.mad_rpc_failed_error_pattern = r'ibwarn: \[\d+\] mad_rpc: _do_madrpc failed; dport \(([\w;\s]+)\)'
-        self.mad_rpc_failed_error_prog = re.compile(self.mad_rpc_failed_error_pattern)
 
         self.query_cap_mask_error_metric_name = 'infiniband_query_cap_mask_error'
         self.query_cap_mask_error_metric_help = 'ibwarn_query_cap_mask error catched from STDERR by ibqueryerrors.'
         self.query_cap_mask_error_metric_labels = ['counter_name', 'local_name', 'portid', 'port']
-        self.query_cap_mask_error_pattern = r'ibwarn: \[\d+\] query_cap_mask: (\w+) query failed on (.*), ([\w;\s]+) port (\d+)'
-        self.query_cap_mask_error_prog = re.compile(self.query_cap_mask_error_pattern)
 
         self.print_error_metric_name = 'infiniband_print_error'
         self.print_error_metric_help = 'ibwarn_print_error catched from STDERR by ibqueryerrors.'
         self.print_error_metric_labels = ['counter_name', 'local_name', 'portid', 'port']
-        self.print_error_pattern = r'ibwarn: \[\d+\] print_errors: (\w+) query failed on (.*), ([\w;\s]+) port (\d+)'
-        self.print_error_prog = re.compile(self.print_error_pattern)
 
-        self.ibqueryerrors_header_regex_str = r'^Errors for (?:0[x][\da-f]+ )?\"(.*)\"$'
+    def parse_counter(self, s):
+        """
+        Returns a list of (index, name, value) for the counters found in s,
+        index points in self.counter_objs and is None for unknown counters.
+        """
+        # findall() hands back (name, value) tuples without building a match
+        # object per counter
+        counter_idx = self.counter_idx
+        return [(counter_idx.get(name), name, int(value))
+                for name, value in _COUNTER_PROG.findall(s)]
 
-        self.switch_all_ports_pattern = re.compile(r'\s*GUID 0[x][\da-f]+ port ALL: (?:\[.*\])+')
+    def parse_port(self, s):
+        """
+        Split a port line printed by ibqueryerrors, e.g.:
 
-        self.port_pattern = re.compile(r'\s*GUID (0x.*) port (\d+):(.*)')
-        self.link_pattern = re.compile(r'\s*Link info:\s+(\d+)\s+(\d+)\[\s+\] ==\(')
-        self.active_link_pattern = re.compile(r'\s*Link info:\s+(?P<LID>\d+)\s+(?P<port>\d+).*(?P<Width>\d)X\s+(?P<Speed>[\d+\.]*) Gbps.* Active\/  LinkUp.*(?P<remote_GUID>0x\w+)\s+(?P<remote_LID>\d+)\s+(?P<remote_port>\d+).*\"(?P<node_name>.*)\"')  # noqa: E501
+        GUID 0x506b4b03005d3101 port 2: [LinkDownedCounter == 1] [PortXmitWait == 22]
 
-    def chunks(self, x, n):
-        for i in range(0, len(x), n):
-            yield x[i:i + n]
+        Returns a (guid, port, counters) tuple, or None when the line is not
+        a port line.
+        """
 
-    def parse_counter(self, s):
-        counters = {}
+        fields = s.split(None, 4)
 
-        for counter in re.findall(r'\[(.*?)\]', s):
-            c = re.search(r'(\w+) == (\d+).*?', counter)
-            if c:
-                counters[c.group(1)] = int(c.group(2))
-        return counters
+        if (len(fields) >= 4
+                and fields[0] == 'GUID'
+                and fields[1].startswith('0x')
+                and fields[2] == 'port'
+                and fields[3][-1:] == ':'
+                and fields[3][:-1].isdigit()):
+            return fields[1], fields[3][:-1], fields[4] if len(fields) == 5 else ''
 
-    def reset_counter(self, guid, port, reason):
-        if guid in self.node_name:
-            switch_name = self.node_name[guid]
-        else:
-            switch_name = guid
+        m = _PORT_PROG.match(s)
 
-        if self.can_reset_counter:
-            logging.info('Reseting counters on %s port %s due to %s',  # noqa: E501
-                         switch_name,
-                         port,
-                         reason)
-            process = subprocess.Popen(['perfquery', '-R', '-G', guid, port],
-                                       stdout=subprocess.PIPE)
-            process.communicate()
-        else:
-            logging.warning('Counters on %s port %s is maxed out on %s',  # noqa: E501
-                            switch_name,
-                            port,
-                            reason)
+        if m:
+            return m.groups()
 
-    def build_stderr_metrics(self, stderr):
-        logging.debug('Processing stderr errors retrieved by ibqueryerrors')
+        return None
 
-        bad_status_error_metric = GaugeMetricFamily(
-            self.bad_status_error_metric_name,
-            self.bad_status_error_metric_help,
-            labels=self.bad_status_error_metric_labels)
-
-        query_failed_error_metric = GaugeMetricFamily(
-            self.query_failed_error_metric_name,
-            self.query_failed_error_metric_help,
-            labels=self.query_failed_error_metric_labels)
-
-        mad_rpc_failed_error_metric = GaugeMetricFamily(
-            self.mad_rpc_failed_error_metric_name,
-            self.mad_rpc_failed_error_metric_help,
-            labels=self.mad_rpc_failed_error_metric_labels)
-
-        query_cap_mask_error_metric = GaugeMetricFamily(
-            self.query_cap_mask_error_metric_name,
-            self.query_cap_mask_error_metric_help,
-            labels=self.query_cap_mask_error_metric_labels)
-
-        print_error_metric = GaugeMetricFamily(
-            self.print_error_metric_name,
-            self.print_error_metric_help,
-            labels=self.print_error_metric_labels)
-
-        stderr_metrics = [
-            bad_status_error_metric,
-            query_failed_error_metric,
-            mad_rpc_failed_error_metric,
-            query_cap_mask_error_metric,
-            print_error_metric]
+    def is_link_info(self, s):
+        """
+        Tell if a line starts like a "Link info" line printed by
+        ibqueryerrors, e.g. "Link info:     12    2[  ] ==(", with numeric
+        LID and port columns.
+        """
 
-        error = False
+        head, _, rest = s.lstrip().partition('Link info:')
 
-        for line in stderr.splitlines():
-            logging.debug('STDERR line: %s', line)
+        if not head and rest[:1].isspace():
+            fields = rest.split(None, 2)
 
-            if self.process_bad_status_error(line, bad_status_error_metric):
-                pass
-            elif self.process_query_failed_error(line, query_failed_error_metric):
-                pass
-            elif self.mad_rpc_recv_failed_prog.match(line):
-                pass
-            elif self.process_mad_rpc_failed(line, mad_rpc_failed_error_metric):
-                pass
-            elif self.process_query_cap_mask(line, query_cap_mask_error_metric):
-                pass
-            elif self.process_print_errors(line, print_error_metric):
-                pass
-            else:
-                if not error:
-                    error = True
-                logging.error('Could not process line from STDERR: %s', line)
+            if (len(fields) == 3
+                    and fields[0].isdecimal()
+                    and fields[1][-1:] == '['
+                    and fields[1][:-1].isdecimal()
+                    and fields[2].startswith('] ==(')):
+                return True
 
-        return stderr_metrics, error
+        return False
 
-    def process_bad_status_error(self, line, error):
+    def parse_active_link(self, s):
+        """
+        Split an active "Link info" line printed by ibqueryerrors, e.g.:
 
-        result = self.bad_status_error_prog.match(line)
+        Link info:     12    2[  ] ==( 4X      25.78125 Gbps Active/  LinkUp)==>  0x506b4b0300e5e461     34    1[  ] "node1 mlx5_0" ( )
 
-        if result:
+        Returns a dict keyed like the groups of _ACTIVE_LINK_PROG, or None
+        when the link is not active.
+        """
 
-            labels = [
-                result.group(1),    # path
-                result.group(2),    # status
-                result.group(3)]    # error
+        if ' Active/  LinkUp' not in s:
+            return None
+
+        local, _, rest = s.partition('==(')
+        state, _, remote = rest.partition(')==>')
+        remote, _, _ = remote.rpartition('"')
+        remote, quote, node_name = remote.rpartition('"')
+
+        local_fields = local.split()
+        state_fields = state.split()
+        remote_fields = remote.split()
+
+        if (quote
+                and len(local_fields) >= 4
+                and len(state_fields) == 5
+                and len(remote_fields) >= 3
+                and state_fields[0][:-1].isdigit()
+                and state_fields[0][-1] == 'X'
+                and state_fields[1].replace('.', '', 1).isdigit()
+                and state_fields[2] == 'Gbps'
+                and remote_fields[0].startswith('0x')):
+
+            remote_port = remote_fields[2].partition('[')[0]
+
+            if remote_port.isdigit():
+                return {
+                    'LID': local_fields[2],
+                    'port': local_fields[3].partition('[')[0],
+                    'Width': state_fields[0][:-1],
+                    'Speed': state_fields[1],
+                    'remote_GUID': remote_fields[0],
+                    'remote_LID': remote_fields[1],
+                    'remote_port': remote_port,
+                    'node_name': node_name,
+                }
+
+        m = _ACTIVE_LINK_PROG.match(s)
+
+        if m:
+            return m.groupdict()
+
+        return None
 
-            error.add_metric(labels, 1)
+    def reset_counter(self, guid, port, reason):
+        if self.can_reset_counter:
+            # perfquery is run by flush_resets() once the scrape is done
+            self.pending_resets.append((guid, port, reason))
+        else:
+            logging.warning('Counters on %s port %s is maxed out on %s',  # noqa: E501
+                            self.node_name.get(guid, guid),
+                            port,
+                            reason)
 
-            return True
+    def flush_resets(self, resets):
+        """
+        The method submits the resets queued by reset_counter() during a
+        scrape to the reset executor, which runs up to _RESET_WORKERS
+        perfquery at the same time. perfquery -R clears every counter of a
+        port, so it is only run once per port whatever the number of
+        counters maxed out, and not again while a reset of that port from a
+        previous scrape is still running.
 
-        return False
+        Parameters:
+            * resets (List[Tuple[str, str, str]]) - guid, port and counter
+        """
 
-    def process_query_failed_error(self, line, error):
+        reasons = {}
+        for guid, port, reason in resets:
+            reasons.setdefault((guid, port), []).append(reason)
 
-        result = self.query_failed_error_prog.match(line)
+        for (guid, port), port_reasons in reasons.items():
+            with self.resets_lock:
+                if (guid, port) in self.resets_in_flight:
+                    logging.debug('Reset of counters on %s port %s is still running',  # noqa: E501
+                                  self.node_name.get(guid, guid),
+                                  port)
+                    continue
+                self.resets_in_flight.add((guid, port))
 
-        if result:
+            logging.info('Reseting counters on %s port %s due to %s',  # noqa: E501
+                         self.node_name.get(guid, guid),
+                         port,
+                         ', '.join(port_reasons))
+            self.reset_executor.submit(self.reset_port, guid, port)
 
-            labels = [
-                result.group(1),    # counter_name
-                result.group(2),    # local_name
-                result.group(3),    # lid
-                result.group(4)]    # port
+    def reset_port(self, guid, port):
+        """
+        The method runs perfquery -R on a port, it is called from the reset
+        executor and logs the failures since nobody waits for its result.
 
-            error.add_metric(labels, 1)
+        Parameters:
+            * guid (str) - GUID of the switch or CA
+            * port (str) - port number
+        """
 
-            return True
+        try:
+            process = subprocess.run(
+                [self.perfquery_path, '-R', '-G', guid, port],
+                stdout=subprocess.DEVNULL,
+                close_fds=False,
+                timeout=_RESET_TIMEOUT)
+        except (OSError, subprocess.SubprocessError) as e:
+            logging.error('Could not reset counters on %s port %s: %s',
+                          self.node_name.get(guid, guid),
+                          port,
+                          e)
+        else:
+            if process.returncode != 0:
+                logging.error('perfquery failed to reset counters on %s port %s, exit code %d',  # noqa: E501
+                              self.node_name.get(guid, guid),
+                              port,
+                              process.returncode)
+        finally:
+            with self.resets_lock:
+                self.resets_in_flight.discard((guid, port))
 
-        return False
+    def build_stderr_metrics(self, stderr):
+        logging.debug('Processing stderr errors retrieved by ibqueryerrors')
 
-    def process_mad_rpc_failed(self, line, error):
+        # Maps each alternative of _COMBINED_STDERR_PROG to the name, help
+        # and labels of the metric it feeds, lines that are known but not
+        # reported map to None. The metrics are only created once a line
+        # needs them since a clean STDERR is the common case.
+        metric_info = {
+            'bad_status_error': (
+                self.bad_status_error_metric_name,
+                self.bad_status_error_metric_help,
+                self.bad_status_error_metric_labels),
+            'query_failed_error': (
+                self.query_failed_error_metric_name,
+                self.query_failed_error_metric_help,
+                self.query_failed_error_metric_labels),
+            'mad_rpc_recv_failed': None,
+            'mad_rpc_failed_error': (
+                self.mad_rpc_failed_error_metric_name,
+                self.mad_rpc_failed_error_metric_help,
+                self.mad_rpc_failed_error_metric_labels),
+            'query_cap_mask_error': (
+                self.query_cap_mask_error_metric_name,
+                self.query_cap_mask_error_metric_help,
+                self.query_cap_mask_error_metric_labels),
+            'print_error': (
+                self.print_error_metric_name,
+                self.print_error_metric_help,
+                self.print_error_metric_labels),
+        }
 
-        result = self.mad_rpc_failed_error_prog.match(line)
+        stderr_metrics = {}
+        error = False
 
-        if result:
+        for line in stderr.splitlines():
+            logging.debug('STDERR line: %s', line)
 
-            labels = [result.group(1)]    # portid
+            result = _COMBINED_STDERR_PROG.match(line)
 
-            error.add_metric(labels, 1)
+            if result is None:
+                if not error:
+                    error = True
+                logging.error('Could not process line from STDERR: %s', line)
+                continue
 
-            return True
+            info = metric_info[result.lastgroup]
 
-        return False
+            if info is not None:
+                metric_name, metric_help, metric_labels = info
 
-    def process_query_cap_mask(self, line, error):
+                metric = stderr_metrics.get(metric_name)
+                if metric is None:
+                    metric = GaugeMetricFamily(
+                        metric_name,
+                        metric_help,
+                        labels=metric_labels)
+                    stderr_metrics[metric_name] = metric
 
-        result = self.query_cap_mask_error_prog.match(line)
+                # The labels are the groups nested in the matched alternative
+                first = result.lastindex
+                metric.add_metric(
+                    result.groups()[first:first + len(metric_labels)], 1)
 
-        if result:
+        return list(stderr_metrics.values()), error
 
-            labels = [
-                result.group(1),    # counter_name
-                result.group(2),    # local_name
-                result.group(3),    # portid
-                result.group(4)]    # port
+    def init_metrics(self):
 
-            error.add_metric(labels, 1)
+        # Only keep the labels of the ports seen during the last scrape
+        self.previous_label_cache = self.label_cache
+        self.label_cache = {}
 
-            return True
+        for gauge_name in self.gauge_names:
+            self.metrics[gauge_name] = GaugeMetricFamily(
+                self.metric_names[gauge_name],
+                self.gauge_info[gauge_name]['help'],
+                labels=self.metric_labels)
 
-        return False
+        for counter_name in self.counter_names:
+            self.metrics[counter_name] = CounterMetricFamily(
+                self.metric_names[counter_name],
+                self.counter_info[counter_name]['help'],
+                labels=self.metric_labels)
 
-    def process_print_errors(self, line, error):
+        # Resolve once per scrape what parse_item() needs for each counter
+        self.counter_objs = [
+            (self.metrics[name].samples.append,
+             self.metrics[name].name + '_total',
+             self.overflow_threshold[name])
+            for name in self.counter_names]
 
-        result = self.print_error_prog.match(line)
+    def process_input(self, lines):
+        """
+        The method splits the ibqueryerrors output into ca and switch items
+        while it is being read, each item is processed as soon as the header
+        of the next one is found.
 
-        if result:
+        Parameters:
+            * lines (Iterable[str])
 
-            labels = [
-                result.group(1),    # counter_name
-                result.group(2),    # local_name
-                result.group(3),    # portid
-                result.group(4)]    # port
+        Throws:
+            ParsingError - Raised during parsing of input content due to inconsistencies.
+        """
 
-            error.add_metric(labels, 1)
+        item = None
 
-            return True
+        for line in lines:
 
-        return False
+            line = line.rstrip('\n')
 
-    def init_metrics(self):
+            # Cheap prefix test first, only header candidates hit the regex
+            match_header = None
+            if line.startswith('Errors for '):
+                match_header = _HEADER_PROG.match(line)
 
-        for gauge_name in self.gauge_info:
-            self.metrics[gauge_name] = GaugeMetricFamily(
-                'infiniband_' + gauge_name.lower(),
-                self.gauge_info[gauge_name]['help'],
-                labels=[
-                    'component',
-                    'local_name',
-                    'local_guid',
-                    'local_port',
-                    'remote_guid',
-                    'remote_port',
-                    'remote_name'
-                ])
-
-        for counter_name in self.counter_info:
-            self.metrics[counter_name] = CounterMetricFamily(
-                'infiniband_' + counter_name.lower(),
-                self.counter_info[counter_name]['help'],
-                labels=[
-                    'component',
-                    'local_name',
-                    'local_guid',
-                    'local_port',
-                    'remote_guid',
-                    'remote_port',
-                    'remote_name'
-                ])
+            if match_header:
+                if item is not None:
+                    self.process_item(self.item_component(item), item)
+                item = [match_header.group(1), []]
+            elif item is None:
+                raise ParsingError('Inconsistent input content detected:\n{}'.format(line))
+            elif item[1] or line.strip():
+                # Blank lines between the header and the first port are dropped
+                item[1].append(line)
+
+        if item is not None:
+            self.process_item(self.item_component(item), item)
+
+    def item_component(self, item):
+        if item[1] and _SWITCH_ALL_PORTS_PROG.match(item[1][0]):
+            return _SWITCH
+        return _CA
 
     def process_item(self, component, item):
         """
         The method processes ibquery ca and switch data.
 
         Parameters:
-            * component (InfinibandItem)
-            * item (Generator[List[str]])
+            * component (str) - 'ca' or 'switch', InfinibandItem members are accepted
+            * item (List[str, List[str]]) - name and lines of the item
 
         Throws:
             ParsingError - Raised during parsing of input content due to inconsistencies.
             RuntimeError - Raised on wrong data type for parameter passed.
         """
 
-        if not isinstance(component, InfinibandItem):
+        if not isinstance(component, str) or component not in _COMPONENTS:
             raise RuntimeError('Wrong data type passed for component: {}'.format(type(component)))
 
+        component = _COMPONENTS[component]
+
         if not isinstance(item, list):
             raise RuntimeError('Wrong data type passed for item: {}'.format(type(item)))
 
@@ -500,104 +698,151 @@ class InfinibandCollector(object):
             raise ParsingError('Item data incomplete:\n{}'.format(item[0]))
 
         name = item[0]
-        data = item[1]
-
-        item_lines = data.lstrip().splitlines()
+        item_lines = item[1]
 
-        if InfinibandItem.SWITCH == component:
+        if component is _SWITCH:
 
             switch_all_ports = item_lines[0]
-            match_switch_all_ports = self.switch_all_ports_pattern.fullmatch(switch_all_ports)
+            match_switch_all_ports = _SWITCH_ALL_PORTS_PROG.fullmatch(switch_all_ports)
 
             if match_switch_all_ports:
                 del item_lines[0]
             else:
                 raise ParsingError('Could not find all port information for item:\n{}'.format(name))
 
-        for item_pair in self.chunks(item_lines, 2):
+        # Bound once per item, these are called for every port
+        parse_port = self.parse_port
+        is_link_info = self.is_link_info
+        parse_active_link = self.parse_active_link
+        parse_item = self.parse_item
 
-            if len(item_pair) == 2:
+        # Pair each port line with the link info line following it
+        lines = iter(item_lines)
 
-                port_item, link_item = item_pair
+        for port_item, link_item in zip_longest(lines, lines):
 
-                match_port = self.port_pattern.match(port_item)
+            if link_item is not None:
 
-                if match_port:
+                port_fields = parse_port(port_item)
 
-                    port = int(match_port.group(2))
+                if port_fields:
 
-                    if port > 0:
+                    port = int(port_fields[1])
 
-                        match_link = self.link_pattern.match(link_item)
+                    if port > 0:
 
-                        if not match_link:
+                        if not is_link_info(link_item):
                             raise ParsingError('No link info line match for port:\n{}'.format(port_item))
 
-                        m_active_link = self.active_link_pattern.match(link_item)
+                        active_link = parse_active_link(link_item)
 
-                        if m_active_link:
-                            self.parse_item(component, name, match_port, m_active_link)
+                        if active_link:
+                            parse_item(component, name, port_fields, active_link)
 
                 elif port_item == '' or "##" in port_item:
 
                     if not (link_item == '' or "##" in link_item):
                         raise ParsingError('Inconsistent data found:\nitem_pair[0]: {}\nitem_pair[1]: {}'.
-                                           format(item_pair[0], item_pair[1]))
+                                           format(port_item, link_item))
 
                     continue
                 else:
                     raise ParsingError('Inconsistent data found:\nitem_pair[0]: {}\nitem_pair[1]: {}'.
-                                       format(item_pair[0], item_pair[1]))
+                                       format(port_item, link_item))
 
             else:
-                if not '##' in item_pair[0]:
-                    raise ParsingError('Inconsistent data found:\n{}'.format(item_pair[0]))
-
-    def parse_item(self, component, name, match_port, match_link):
-
-        guid = match_port.group(1)
-        port = match_port.group(2)
-        counters = self.parse_counter(match_port.group(3))
+                if not '##' in port_item:
+                    raise ParsingError('Inconsistent data found:\n{}'.format(port_item))
+
+    def parse_item(self, component, name, port_fields, link):
+
+        guid, port, counters = port_fields
+        counters = self.parse_counter(counters)
+
+        label_values = (
+            component,
+            name,
+            guid,
+            port,
+            link['remote_GUID'],
+            link['remote_port'],
+            link['node_name'])
+
+        # Samples are appended directly instead of going through add_metric()
+        # so all the samples of a port share a single labels dict, which is
+        # reused from the previous scrape as long as the cabling is the same.
+        # Names and GUIDs repeat across the ports of the fabric, the values
+        # kept in the dict are interned so the cache holds a single copy.
+        key = (guid, port)
+        cached = self.previous_label_cache.get(key)
+        if cached is None or cached[0] != label_values:
+            cached = (label_values,
+                      dict(zip(self.metric_labels, map(sys.intern, label_values))))
+        self.label_cache[key] = cached
+        labels = cached[1]
+
+        metrics = self.metrics
+        counter_objs = self.counter_objs
+
+        for gauge in self.gauge_names:
+
+            metric = metrics[gauge]
+            metric.samples.append(Sample(metric.name, labels, link[gauge]))
+
+        for idx, counter, value in counters:
+
+            if idx is None:
+                self.scrape_with_errors = True
+                logging.error('Missing description for counter metric: %s', counter)
+                continue
 
-        for gauge in self.gauge_info:
+            append_sample, sample_name, threshold = counter_objs[idx]
+            append_sample(Sample(sample_name, labels, value))
 
-            label_values = [
-                component.value,
-                name,
-                guid,
-                port,
-                match_link.group('remote_GUID'),
-                match_link.group('remote_port'),
-                match_link.group('node_name')]
+            if value >= threshold:
+                self.reset_counter(guid, port, counter)
 
-            self.metrics[gauge].add_metric(label_values, match_link.group(gauge))
 
-        for counter in counters:
+    def process_stream(self, stream):
+        try:
+            self.process_input(stream)
+        except ParsingError as e:
+            logging.error(e)
+            self.scrape_with_errors = True
+            return False
 
-            label_values = [
-                component.value,
-                name,
-                guid,
-                port,
-                match_link.group('remote_GUID'),
-                match_link.group('remote_port'),
-                match_link.group('node_name')]
+        return True
 
-            try:
-                self.metrics[counter].add_metric(label_values, counters[counter])
+    def collect(self):
+        """
+        The method returns the metrics of a complete scrape. The HTTP server
+        handles requests in threads, the lock makes concurrent requests wait
+        for the running scrape instead of sharing its state. When cache_ttl
+        is set, the metrics of a scrape are served again until the scrape
+        started more than cache_ttl seconds ago.
+        """
+        with self.lock:
+            if self.cache_ttl <= 0:
+                return list(self.scrape())
 
-                if counters[counter] >= 2 ** (self.counter_info[counter]['bits'] - 1):  # noqa: E501
-                    self.reset_counter(guid, port, counter)
-            except KeyError:
-                self.scrape_with_errors = True
-                logging.error('Missing description for counter metric: %s', counter)
+            age = time.monotonic() - self.cache_time
+            if self.cache is not None and age < self.cache_ttl:
+                logging.debug('Serving metrics of a scrape started %.1fs ago',
+                              age)
+                return self.cache
 
+            # Let the previous result go before building the next one
+            self.cache = None
+            self.cache_time = time.monotonic()
+            self.cache = list(self.scrape())
+            return self.cache
 
-    def collect(self):
+    def scrape(self):
 
         logging.debug('Start of collection cycle')
 
         self.scrape_with_errors = False
+        self.pending_resets = []
 
         ibqueryerrors_duration = GaugeMetricFamily(
             'infiniband_ibqueryerrors_duration_seconds',
@@ -614,13 +859,13 @@ class InfinibandCollector(object):
 
         self.init_metrics()
 
-        ibqueryerrors_stdout = ""
+        parsed = False
         if self.input_file:
             with open(self.input_file) as f:
-                ibqueryerrors_stdout = f.read()
+                parsed = self.process_stream(f)
         else:
             ibqueryerrors_args = [
-                'ibqueryerrors',
+                self.ibqueryerrors_path,
                 '--verbose',
                 '--details',
                 '--suppress-common',
@@ -637,13 +882,30 @@ class InfinibandCollector(object):
             ibqueryerrors_start = time.time()
             process = subprocess.Popen(ibqueryerrors_args,
                                        stdout=subprocess.PIPE,
-                                       stderr=subprocess.PIPE)
-            process_stdout, process_stderr = process.communicate()
-            ibqueryerrors_stdout = process_stdout.decode("utf-8")
+                                       stderr=subprocess.PIPE,
+                                       encoding='utf-8',
+                                       close_fds=False)
 
-            if process_stderr:
-                ibqueryerrors_stderr = process_stderr.decode("utf-8")
-                
+            # STDOUT is parsed while ibqueryerrors is running, STDERR is
+            # drained in the background so neither pipe can fill up.
+            process_stderr = []
+            stderr_reader = threading.Thread(
+                target=lambda: process_stderr.append(process.stderr.read()))
+            stderr_reader.start()
+
+            try:
+                parsed = self.process_stream(process.stdout)
+            finally:
+                # Closing the pipe stops ibqueryerrors if the parsing bailed out
+                process.stdout.close()
+                process.wait()
+                ibqueryerrors_end = time.time()
+                stderr_reader.join()
+                process.stderr.close()
+
+            ibqueryerrors_stderr = ''.join(process_stderr)
+
+            if ibqueryerrors_stderr:
                 logging.debug("STDERR output retrieved from ibqueryerrrors:\n%s",
                     ibqueryerrors_stderr)
 
@@ -658,46 +920,15 @@ class InfinibandCollector(object):
 
             ibqueryerrors_duration.add_metric(
                 [],
-                time.time() - ibqueryerrors_start)
+                ibqueryerrors_end - ibqueryerrors_start)
             yield ibqueryerrors_duration
 
-        content = re.split(self.ibqueryerrors_header_regex_str,
-                           ibqueryerrors_stdout,
-                           flags=re.MULTILINE)
-        try:
-
-            if not content:
-                raise ParsingError('Input content is empty.')
-
-            if not isinstance(content, list):
-                raise RuntimeError('Input content should be a list.')
-
-            # Drop first line that is empty on successful regex split():
-            if content[0] == '':
-                del content[0]
-            else:
-                raise ParsingError('Inconsistent input content detected:\n{}'.format(content[0]))
-
-            input_data_chunks = self.chunks(content, 2)
-
-            for data_chunk in input_data_chunks:
-
-                match_switch = self.switch_all_ports_pattern.match(data_chunk[1])
-
-                if match_switch:
-                    self.process_item(InfinibandItem.SWITCH, data_chunk)
-                else:
-                    self.process_item(InfinibandItem.CA, data_chunk)
-
-            for counter_name in self.counter_info:
+        if parsed:
+            for counter_name in self.counter_names:
                 yield self.metrics[counter_name]
-            for gauge_name in self.gauge_info:
+            for gauge_name in self.gauge_names:
                 yield self.metrics[gauge_name]
 
-        except ParsingError as e:
-            logging.error(e)
-            self.scrape_with_errors = True
-
         scrape_duration.add_metric([], time.time() - scrape_start)
         yield scrape_duration
 
@@ -707,6 +938,12 @@ class InfinibandCollector(object):
             scrape_ok.add_metric([], 1)
         yield scrape_ok
 
+        # Resetting counters is kept out of the scrape, perfquery runs in
+        # the background once all the metrics have been handed over.
+        if self.pending_resets:
+            resets, self.pending_resets = self.pending_resets, []
+            self.flush_resets(resets)
+
         logging.debug('End of collection cycle')
 
 
@@ -739,6 +976,10 @@ class NoLoggingWSGIRequestHandler(WSGIRequestHandler):
         pass
 
 
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Prometheus collector for a infiniband fabric')
@@ -769,6 +1010,14 @@ var NODE_NAME_MAP')
         '--ca_name',
         type=str,
         help='ibqueryerrors ca_name for different infiniband ports')
+    parser.add_argument(
+        '--cache-ttl',
+        type=float,
+        default=0,
+        dest='cache_ttl',
+        help='Serve the metrics of a scrape again until it started this many \
+seconds ago, keep it below the scrape interval minus the scrape duration, \
+default is 0 (disabled)')
     parser.add_argument("--verbose", help="increase output verbosity",
                         action="store_true")
     parser.add_argument('-v',
@@ -822,7 +1071,9 @@ var NODE_NAME_MAP')
     app = make_wsgi_app(InfinibandCollector(
         can_reset_counter,
         args.input_file,
-        node_name_map))
+        node_name_map,
+        args.cache_ttl))
     httpd = make_server('', args.port, app,
+                        server_class=ThreadingWSGIServer,
                         handler_class=NoLoggingWSGIRequestHandler)
     httpd.serve_forever()